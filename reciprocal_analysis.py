@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
 
 import argparse
+import csv
 import os
-import glob
 import sys
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:  # optional: fall back to the numpy popcount loop
+    HAVE_NUMBA = False
+
 # -----------------------------
 # STAR file parsing
 # -----------------------------
@@ -17,12 +23,13 @@ def read_star_file(star_file):
     Returns a pandas DataFrame.
     """
     headers = []
-    data = []
+    data_start = None
     in_particles = False
     in_loop = False
 
+    # Scan only the header block; the particle rows are handed to the C parser
     with open(star_file, "r") as f:
-        for line in f:
+        for lineno, line in enumerate(f):
             line = line.strip()
 
             if line.startswith("data_particles"):
@@ -40,21 +47,49 @@ def read_star_file(star_file):
             if in_loop:
                 if not line or line.startswith("#"):
                     continue
-                parts = line.split()
-                if len(parts) == len(headers):
-                    data.append(parts)
+                data_start = lineno
+                break
 
-    if not headers or not data:
+    if not headers or data_start is None:
         raise ValueError(f"Failed to parse data_particles from {star_file}")
 
-    df = pd.DataFrame(data, columns=headers)
+    # Keep every column as the original string so STAR values are written back
+    # verbatim. The spare "_extra" column catches rows with one extra field,
+    # which pandas would otherwise turn into an index and shift every column.
+    # Rows with extra fields are skipped and rows with missing fields come
+    # back as NaN and are dropped. Quotes are ordinary characters in STAR.
+    df = pd.read_csv(
+        star_file,
+        sep=r"\s+",
+        engine="c",
+        header=None,
+        names=headers + ["_extra"],
+        index_col=False,
+        skiprows=data_start,
+        quoting=csv.QUOTE_NONE,
+        dtype=str,
+        keep_default_na=False,
+        na_values=[""],
+        on_bad_lines="skip",
+    )
+    df = df[df["_extra"].isna()].drop(columns="_extra").dropna()
+
+    # Only whole comment lines are skipped; '#' inside a value is kept
+    df = df[~df[headers[0]].str.startswith("#")]
+
+    if df.empty:
+        raise ValueError(f"Failed to parse data_particles from {star_file}")
 
     if "rlnImageName" not in df.columns:
         raise ValueError(f"'rlnImageName' column missing in {star_file}")
     if "rlnClassNumber" not in df.columns:
         raise ValueError(f"'rlnClassNumber' column missing in {star_file}")
 
-    df["rlnClassNumber"] = df["rlnClassNumber"].astype(int)
+    classes = df["rlnClassNumber"].astype(np.int16)
+    # Ordered categorical: .cat.categories holds the sorted class numbers
+    df["rlnClassNumber"] = pd.Categorical(
+        classes, categories=np.sort(classes.unique()), ordered=True
+    )
 
     return df
 
@@ -68,22 +103,115 @@ def write_per_class_star(df, job_number, outdir):
     class_dir = os.path.join(outdir, "per_class_star")
     os.makedirs(class_dir, exist_ok=True)
 
-    for cls in sorted(df["rlnClassNumber"].unique()):
-        cls_df = df[df["rlnClassNumber"] == cls]
+    for cls, cls_df in df.groupby("rlnClassNumber", observed=True):
         filename = os.path.join(class_dir, f"job{job_number:03d}_class{cls}.star")
 
-        with open(filename, "w") as f:
+        # Large buffer so the body goes to disk in a few big writes
+        with open(filename, "w", buffering=1 << 20) as f:
             # Write header
             f.write("# version 50001\n\n")
             f.write("data_particles\n\n")
             f.write("loop_\n")
             for col in df.columns:
                 f.write(f"_{col} \n")
-            # Write data
-            for _, row in cls_df.iterrows():
-                f.write(" ".join(str(x) for x in row.values) + "\n")
+            # Write data: values joined by single spaces, never quoted
+            cls_df.to_csv(
+                f,
+                sep=" ",
+                header=False,
+                index=False,
+                lineterminator="\n",
+                quoting=csv.QUOTE_NONE,
+            )
         print(f"Written per-class STAR: {filename}")
 
+# -----------------------------
+# Per-job worker
+# -----------------------------
+def process_job(star_file, job_number, outdir):
+    """
+    Read one job's STAR file and write its per-class STAR files.
+    Returns only the columns needed for the intersection analysis.
+    """
+    df = read_star_file(star_file)
+    write_per_class_star(df, job_number, outdir)
+    return df[["rlnImageName", "rlnClassNumber"]]
+
+# -----------------------------
+# Class membership bitmaps
+# -----------------------------
+# Number of set bits in every possible byte value
+POPCOUNT_LUT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def build_class_bitmap(ids, n_ids):
+    """
+    Pack integer particle ids into a uint64 bitmap with one bit per id.
+    """
+    n_words = (n_ids + 63) // 64
+    mask = np.zeros(n_words * 64, dtype=bool)
+    mask[ids] = True
+    return np.packbits(mask, bitorder="little").view(np.uint64)
+
+
+def popcount(bitmaps):
+    """
+    Count the set bits of uint64 bitmaps along the last axis.
+    """
+    return POPCOUNT_LUT[bitmaps.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+if HAVE_NUMBA:
+
+    @njit(cache=True)
+    def _popcount64(x):
+        # SWAR bit count; LLVM lowers this pattern to a single popcnt
+        x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+        x = (x & np.uint64(0x3333333333333333)) + (
+            (x >> np.uint64(2)) & np.uint64(0x3333333333333333)
+        )
+        x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+        return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+    @njit(parallel=True, cache=True)
+    def _count_intersections_numba(bitmaps, label_jobs, counts):
+        n_labels, n_words = bitmaps.shape
+        # Only j > i is counted and mirrored; each cell has a single writer
+        for i in prange(n_labels):
+            for j in range(i + 1, n_labels):
+                if label_jobs[i] == label_jobs[j]:
+                    continue
+                total = np.uint64(0)
+                for w in range(n_words):
+                    total += _popcount64(bitmaps[i, w] & bitmaps[j, w])
+                counts[i, j] = total
+                counts[j, i] = total
+
+
+def count_intersections(bitmaps, label_jobs):
+    """
+    Count shared particles for every pair of labels from different jobs.
+    Returns a symmetric int32 (labels x labels) matrix; within-job cells
+    are zero.
+    """
+    n_labels = bitmaps.shape[0]
+    counts = np.zeros((n_labels, n_labels), dtype=np.int32)
+
+    if HAVE_NUMBA:
+        _count_intersections_numba(bitmaps, label_jobs, counts)
+        return counts
+
+    # Intersections are symmetric: only pairs with j > i are counted
+    for i in range(n_labels):
+        # omit within-job comparisons
+        targets = i + 1 + np.flatnonzero(label_jobs[i + 1:] != label_jobs[i])
+        # One AND + popcount of class i against all later cross-job labels
+        row = popcount(bitmaps[i] & bitmaps[targets])
+        counts[i, targets] = row
+        counts[targets, i] = row
+
+    return counts
+
 # -----------------------------
 # Main logic
 # -----------------------------
@@ -129,15 +257,21 @@ def main():
     # ---------------------------------------
     # Read and split STAR files per job/class
     # ---------------------------------------
-    job_class_particles = {}
+    job_stars = {}
 
     for job in args.jobs:
         job_str = f"{job:03d}"
         job_dir = os.path.join(class3d_dir, f"job{job_str}")
 
-        star_candidates = sorted(
-            glob.glob(os.path.join(job_dir, "run_it*_data.star"))
-        )
+        star_candidates = []
+        if os.path.isdir(job_dir):
+            with os.scandir(job_dir) as entries:
+                star_candidates = [
+                    entry.path
+                    for entry in entries
+                    if entry.name.startswith("run_it")
+                    and entry.name.endswith("_data.star")
+                ]
 
         if not star_candidates:
             print(
@@ -146,54 +280,76 @@ def main():
             )
             continue
 
-        last_star = star_candidates[-1]
+        # Iteration numbers are zero-padded, so the largest name is the last
+        last_star = max(star_candidates)
         print(f"Job {job_str}: using STAR file {last_star}")
 
-        df = read_star_file(last_star)
-
-        # Write per-class STAR files
-        write_per_class_star(df, job, args.outdir)
+        job_stars[job] = last_star
 
-        class_dict = {}
-        for cls in sorted(df["rlnClassNumber"].unique()):
-            class_dict[cls] = set(
-                df[df["rlnClassNumber"] == cls]["rlnImageName"]
-            )
-
-        job_class_particles[job] = class_dict
-
-    if len(job_class_particles) < 2:
+    if len(job_stars) < 2:
         raise RuntimeError("Need at least two valid jobs for reciprocal analysis")
 
+    # Jobs are independent, so parse and split them in parallel
+    max_workers = min(len(job_stars), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        frames = executor.map(
+            process_job,
+            job_stars.values(),
+            job_stars.keys(),
+            [args.outdir] * len(job_stars),
+        )
+        job_frames = dict(zip(job_stars.keys(), frames))
+
     # ---------------------------------------
-    # Compute cross-job intersection matrices
+    # Map image names to shared integer ids
     # ---------------------------------------
-    count_matrix = defaultdict(dict)
-    fraction_matrix = defaultdict(dict)
+    all_names = pd.concat(
+        [df["rlnImageName"] for df in job_frames.values()], ignore_index=True
+    )
+    image_codes, image_names = pd.factorize(all_names)
+    image_codes = image_codes.astype(np.int32)
+    n_ids = len(image_names)
 
-    for job_a, classes_a in job_class_particles.items():
-        for cls_a, particles_a in classes_a.items():
-            label_a = f"job{job_a:03d}_class{cls_a}"
+    # Preallocate one row of bits per job/class label
+    n_labels = sum(
+        len(df["rlnClassNumber"].cat.categories) for df in job_frames.values()
+    )
+    bitmaps = np.empty((n_labels, (n_ids + 63) // 64), dtype=np.uint64)
+    labels = []
+    label_jobs = np.empty(n_labels, dtype=np.int64)
+    offset = 0
+
+    for job, df in job_frames.items():
+        job_codes = image_codes[offset:offset + len(df)]
+        offset += len(df)
 
-            for job_b, classes_b in job_class_particles.items():
-                if job_a == job_b:
-                    continue  # omit within-job comparisons
+        # Single grouping pass: class number -> row positions
+        class_rows = df.groupby("rlnClassNumber", observed=True).indices
+        for cls, rows in class_rows.items():
+            i = len(labels)
+            labels.append(f"job{job:03d}_class{cls}")
+            label_jobs[i] = job
+            bitmaps[i] = build_class_bitmap(job_codes[rows], n_ids)
 
-                for cls_b, particles_b in classes_b.items():
-                    label_b = f"job{job_b:03d}_class{cls_b}"
+    class_sizes = popcount(bitmaps)
 
-                    intersect = particles_a & particles_b
-                    count = len(intersect)
-                    frac = count / len(particles_a) if particles_a else 0.0
+    # ---------------------------------------
+    # Compute cross-job intersection matrices
+    # ---------------------------------------
+    count_matrix = count_intersections(bitmaps, label_jobs)
 
-                    count_matrix[label_a][label_b] = count
-                    fraction_matrix[label_a][label_b] = frac
+    fraction_matrix = np.divide(
+        count_matrix,
+        class_sizes[:, None],
+        out=np.zeros(count_matrix.shape),
+        where=class_sizes[:, None] > 0,
+    )
 
     # ---------------------------------------
     # Save matrices
     # ---------------------------------------
-    count_df = pd.DataFrame.from_dict(count_matrix, orient="index").fillna(0).astype(int)
-    frac_df = pd.DataFrame.from_dict(fraction_matrix, orient="index").fillna(0.0)
+    count_df = pd.DataFrame(count_matrix, index=labels, columns=labels)
+    frac_df = pd.DataFrame(fraction_matrix, index=labels, columns=labels)
 
     count_df.to_csv(os.path.join(args.outdir, "intersection_counts.csv"))
     frac_df.to_csv(os.path.join(args.outdir, "intersection_fractions.csv"))
@@ -201,20 +357,16 @@ def main():
     # ---------------------------------------
     # Save pysankey input (long format) without reciprocal duplicates
     # ---------------------------------------
-    pysankey_rows = []
-    idx = 0
-    for jobA_class, targets in count_matrix.items():
-        jobA_no = int(jobA_class.split("_")[0].replace("job", ""))
-        for jobB_class, count in targets.items():
-            jobB_no = int(jobB_class.split("_")[0].replace("job", ""))
-            if jobA_no >= jobB_no:
-                continue  # skip reciprocal / redundant pairs
-            pysankey_rows.append([idx, jobA_class, jobB_class, count])
-            idx += 1
-
-    pysankey_df = pd.DataFrame(
-        pysankey_rows, columns=["id", "jobANo_class", "jobBNo_class", "#particles"]
+    pysankey_df = (
+        count_df.rename_axis(index="jobANo_class", columns="jobBNo_class")
+        .stack()
+        .rename("#particles")
+        .reset_index()
     )
+    # Keep only jobA < jobB to skip reciprocal / redundant pairs
+    keep = np.repeat(label_jobs, n_labels) < np.tile(label_jobs, n_labels)
+    pysankey_df = pysankey_df[keep].reset_index(drop=True)
+    pysankey_df.insert(0, "id", np.arange(len(pysankey_df)))
     pysankey_df.to_csv(os.path.join(args.outdir, "pysankey_input.csv"), index=False)
 
     print("Reciprocal analysis complete.")
@@ -0,0 +1,62 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reciprocal_analysis import read_star_file
+
+
+def write_star(tmp_path, text):
+    star_file = tmp_path / "run_it025_data.star"
+    star_file.write_text(text)
+    return str(star_file)
+
+
+def test_extra_field_on_first_row_is_skipped(tmp_path):
+    star_file = write_star(
+        tmp_path,
+        "data_particles\n\nloop_\n"
+        "_rlnX #1\n_rlnClassNumber #2\n_rlnY #3\n_rlnImageName #4\n"
+        "10.0 1 3 a@x EXTRA\n"
+        "11.0 2 4 b@x\n"
+        "12.0 1 5 c@x\n",
+    )
+
+    df = read_star_file(star_file)
+
+    assert df["rlnImageName"].tolist() == ["b@x", "c@x"]
+    assert df["rlnClassNumber"].tolist() == [2, 1]
+    assert df["rlnY"].tolist() == ["4", "5"]
+
+
+def test_quote_in_particle_value_is_kept(tmp_path):
+    star_file = write_star(
+        tmp_path,
+        "data_particles\n\nloop_\n"
+        "_rlnImageName #1\n_rlnClassNumber #2\n_rlnX #3\n"
+        '"a@x 1 0.5\n'
+        "b@x 2 0.6\n",
+    )
+
+    df = read_star_file(star_file)
+
+    assert df["rlnImageName"].tolist() == ['"a@x', "b@x"]
+    assert df["rlnClassNumber"].tolist() == [1, 2]
+
+
+def test_quote_in_optics_block_does_not_hide_particles(tmp_path):
+    star_file = write_star(
+        tmp_path,
+        "data_optics\n\nloop_\n"
+        "_rlnOpticsGroupName #1\n"
+        '"opticsGroup1\n\n'
+        "data_particles\n\nloop_\n"
+        "_rlnImageName #1\n_rlnClassNumber #2\n"
+        "a@x 1\n"
+        "b@x 2\n",
+    )
+
+    df = read_star_file(star_file)
+
+    assert df["rlnImageName"].tolist() == ["a@x", "b@x"]
+    assert df["rlnClassNumber"].tolist() == [1, 2]